@@ -1,4 +1,6 @@
 from .common import *
+from .shm import *
+from .array_pool import *
 from .job import *
 from .buffer import *
-from .stream import *
\ No newline at end of file
+from .stream import *
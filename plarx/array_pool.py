@@ -0,0 +1,103 @@
+from collections import defaultdict
+import os
+import sys
+import threading
+import typing as ty
+import weakref
+
+import numpy as np
+
+from .common import exporter
+export, __all__ = exporter()
+
+# Pools to reset in forked child processes
+_pools: 'weakref.WeakSet[ArrayPool]' = weakref.WeakSet()
+
+
+def _reset_pools_after_fork():
+    for pool in _pools:
+        pool._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
+@export
+class ArrayPool:
+    """Reusable memory for numpy arrays.
+
+    Jobs can use self.array_pool.empty(shape, dtype) instead of np.empty
+    to make their results. When the Stream removes a chunk from its
+    buffer, the memory behind it returns to the pool, and is handed out
+    again once nothing else refers to it.
+
+    Each process has its own pool: worker processes get an empty pool,
+    whether the pool is pickled to them or inherited through a fork.
+    """
+    alignment = 64      # Bytes. Enough for any SIMD instruction set.
+    max_per_size = 8    # Maximum number of free blocks kept per size
+
+    _free: ty.Dict[int, ty.List[np.ndarray]]  # {size: [block, ...]}
+    _blocks: weakref.WeakValueDictionary     # {id(block): block}
+
+    def __init__(self):
+        self._reset()
+        _pools.add(self)
+
+    def _reset(self):
+        # Also called in forked children, where the lock may have been
+        # held by another thread of the parent at the time of the fork.
+        self._free = defaultdict(list)
+        self._blocks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        return ArrayPool, tuple()
+
+    def acquire(self, nbytes: int) -> np.ndarray:
+        """Return aligned uint8 array of nbytes, possibly reused"""
+        size = 1 << max(nbytes - 1, 0).bit_length()
+        block = None
+        with self._lock:
+            free = self._free[size]
+            for i in range(len(free)):
+                # If anything besides the free list and getrefcount's
+                # argument refers to the block, someone still uses it.
+                if sys.getrefcount(free[i]) == 2:
+                    block = free.pop(i)
+                    break
+
+        if block is None:
+            block = np.empty(size + self.alignment, dtype=np.uint8)
+            self._blocks[id(block)] = block
+        offset = -block.ctypes.data % self.alignment
+        return block[offset:offset + nbytes]
+
+    def empty(self, shape, dtype=np.float64) -> np.ndarray:
+        """Return uninitialized array of shape and dtype, like np.empty"""
+        dtype = np.dtype(dtype)
+        try:
+            shape = tuple(shape)
+        except TypeError:
+            shape = (shape,)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self.acquire(nbytes).view(dtype).reshape(shape)
+
+    def recycle(self, x):
+        """Return the memory of x to the pool, if it came from the pool.
+
+        The memory will only be reused once x and all other views of
+        it are gone.
+        """
+        if not isinstance(x, np.ndarray):
+            return
+        while isinstance(x.base, np.ndarray):
+            x = x.base
+        if self._blocks.get(id(x)) is not x:
+            return
+        with self._lock:
+            free = self._free[x.nbytes - self.alignment]
+            if (len(free) < self.max_per_size
+                    and not any([block is x for block in free])):
+                free.append(x)
@@ -7,40 +7,75 @@ export, __all__ = exporter()
 
 @export
 class Buffer:
+    __slots__ = ('name', '_stored', '_seen_by_consumers', '_last_contiguous',
+                 '_seen_by_all_consumers', '_cleaned_up_to', '_waiting',
+                 '_n_waiting', '_yielding_to_user', '_last_yielded_to_user',
+                 '_array_pool')
+
     name: str                  # Name of data type
     _stored: ty.Dict[int, ty.Any]
                                 # [(chunk_i, data), ...]
     _seen_by_consumers: ty.Dict[plarx.Job, int]
                                 # Last chunk seen by each of the tasks
                                 # that need it
-    _last_contiguous = -1       # Latest chunk that has arrived
+    _last_contiguous: int       # Latest chunk that has arrived
                                 # for which all previous chunks have arrived
+    _seen_by_all_consumers: int   # Minimum of _seen_by_consumers
+    _cleaned_up_to: int           # All chunks up to this have been removed
+    _waiting: ty.Dict[int, ty.List[plarx.Job]]
+                                # Jobs waiting for a chunk to arrive
+    _n_waiting: int             # Total number of jobs in _waiting
 
-    _yielding_to_user = False     # Output must be yielded to the user
-    _last_yielded_to_user = -1    # Last chunk yielded to the user
+    _yielding_to_user: bool       # Output must be yielded to the user
+    _last_yielded_to_user: int    # Last chunk yielded to the user
 
     def __init__(self,
                  name,
                  wanted_by: ty.List[plarx.Job],
-                 yield_to_user=False, ):
+                 yield_to_user=False,
+                 array_pool: plarx.ArrayPool = None):
         """Buffer of stored data of one type.
 
         :param name: Name of the data type to be stored
         :param wanted_by: List of jobs that want this data type
         :param yield_to_user: if True (default False), this data type
         will be yielded to the user.
+        :param array_pool: ArrayPool to return data to when it is
+        removed from the buffer (optional)
         """
         self.name = name
+        self._array_pool = array_pool
         self._stored = dict()
         self._seen_by_consumers = {tg: -1
                                    for tg in wanted_by}
+        self._last_contiguous = -1
+        self._seen_by_all_consumers = -1
+        self._cleaned_up_to = -1
+        self._waiting = dict()
+        self._n_waiting = 0
         self._yielding_to_user = yield_to_user
+        self._last_yielded_to_user = -1
 
-    def add(self, data, chunk_i: int):
-        """Add a new chunk of data to the buffer"""
+    def add(self, data, chunk_i: int) -> ty.List[plarx.Job]:
+        """Add a new chunk of data to the buffer.
+        Return list of jobs that were waiting for it.
+        """
         self._stored[chunk_i] = data
-        if self._last_contiguous == chunk_i - 1:
+        # Chunks can arrive out of order; this one may close a gap
+        while self._last_contiguous + 1 in self._stored:
             self._last_contiguous += 1
+        unlocked = self._waiting.pop(chunk_i, [])
+        self._n_waiting -= len(unlocked)
+        return unlocked
+
+    def wait_for(self, chunk_i, job):
+        """Register that job is waiting for chunk_i to arrive"""
+        self._waiting.setdefault(chunk_i, []).append(job)
+        self._n_waiting += 1
+
+    def n_waiting(self):
+        """Return number of jobs waiting for a chunk to arrive"""
+        return self._n_waiting
 
     def grab_for(self, chunk_i, job):
         """Return chunk_i for use in job"""
@@ -50,7 +85,12 @@ class Buffer:
         assert chunk_i in self._stored, \
             f"Cannot get {chunk_i} for {job}, have only {self._stored.keys()}"
 
+        previously_seen = self._seen_by_consumers[job]
         self._seen_by_consumers[job] = chunk_i
+        if previously_seen == self._seen_by_all_consumers:
+            # job might have been the slowest consumer
+            self._seen_by_all_consumers = min(
+                self._seen_by_consumers.values())
         return self._stored[chunk_i]
 
     def slurp_for(self, job) -> ty.List:
@@ -69,8 +109,7 @@ class Buffer:
 
         chunk_i = self._last_yielded_to_user + 1
         while chunk_i in self._stored:
-            result = self._stored[chunk_i]
-            yield result
+            yield self._stored[chunk_i]
             self._last_yielded_to_user = chunk_i
             chunk_i += 1
 
@@ -78,24 +117,38 @@ class Buffer:
         """Remove chunks seen by all consumers (and user, if yielding to user)
         from the buffer
         """
-        seen_by_all = min(self._seen_by_consumers.values(),
-                          default=float('inf'))
         if self._yielding_to_user:
-            seen_by_all = min(seen_by_all, self._last_yielded_to_user)
+            if self._seen_by_consumers:
+                seen_by_all = min(self._seen_by_all_consumers,
+                                  self._last_yielded_to_user)
+            else:
+                seen_by_all = self._last_yielded_to_user
         elif not len(self._seen_by_consumers):
             raise RuntimeError(f"{self.name} is not consumed by anyone??")
+        else:
+            seen_by_all = self._seen_by_all_consumers
 
-        self._stored = {chunk_i: data
-                        for chunk_i, data in self._stored.items()
-                        if chunk_i > seen_by_all}
+        # Chunks are seen in order, so everything up to seen_by_all
+        # has arrived, and we only have to visit newly seen chunks.
+        for chunk_i in range(self._cleaned_up_to + 1, seen_by_all + 1):
+            data = self._stored.pop(chunk_i, None)
+            if self._array_pool is not None:
+                self._array_pool.recycle(data)
+        self._cleaned_up_to = max(self._cleaned_up_to, seen_by_all)
 
     def print_status(self):
         print(f"{self.name}: stored: {list(self._stored.keys())}, "
               f"last_contiguous: {self._last_contiguous}, "
               f"seen: {self._seen_by_consumers}")
 
-    def has_stored(self, chunk_id):
-        return chunk_id in self._stored
+    def __contains__(self, chunk_i):
+        return chunk_i in self._stored
+
+    def has_stored(self, chunk_i):
+        return chunk_i in self._stored
+
+    def __getitem__(self, chunk_i):
+        return self._stored[chunk_i]
 
     def n_stored(self):
         return len(self._stored)
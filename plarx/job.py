@@ -1,5 +1,4 @@
 import concurrent.futures
-from functools import partial
 import typing as ty
 from types import MethodType
 
@@ -13,6 +12,26 @@ class CannotSubmitNewTask(Exception):
     pass
 
 
+# Jobs known to this worker process, {id of job in main process: job}
+_worker_jobs: ty.Dict[int, 'Job'] = dict()
+
+
+def _init_worker(jobs: ty.Dict[int, 'Job']):
+    """Initialize a worker process with the jobs it can run.
+    Jobs (and any large state they hold) are sent only once per worker,
+    or simply inherited if the worker is forked.
+    """
+    _worker_jobs.update(jobs)
+
+
+def _run_in_worker(job_id: int, method: str, /, **kwargs):
+    """Run method of job in a worker process.
+    Arrays are passed both ways through shared memory where possible.
+    """
+    f = getattr(_worker_jobs[job_id], method)
+    return plarx.run_and_share(f, **plarx.from_shared(kwargs))
+
+
 @export
 class Task(ty.NamedTuple):
     """Task object, tracking a future submitted to a pool"""
@@ -33,6 +52,10 @@ class Task(ty.NamedTuple):
     # future directly stores the result.
     future: concurrent.futures.Future
 
+    # Shared memory segments holding the inputs sent to a worker process.
+    # The worker releases these, unless the task is cancelled first.
+    shared_inputs: ty.Tuple[str, ...] = tuple()
+
     def __repr__(self):
         return f"Task[{self.job}:{self.chunk_i}]"
 
@@ -47,14 +70,28 @@ class Job:
     changing_inputs = False     # If True, task_function returns
                                 # (result, inputs_wanted_next_time)
                                 # Cannot parallelize.
-    priority = 0                # 0 = saver/target, 1 = source, 2 = other
+    priority = 0                # Lower is scheduled first
+    expected_cost = 1.          # Relative cost of a task, used to find
+                                # the critical path through the jobs
+    target_chunk_size = None    # For sources: desired rows per chunk
+    chunk_hint = None           # Chunks should preferably have a multiple
+                                # of this many rows, e.g. if the job
+                                # processes data in fixed-size blocks
 
     wants_input: ty.Dict[str, int]  # [(dtype, chunk_i), ...] of inputs
                                     # needed to make progress
     seen_input: ty.Dict[str, int]   # [(dtype, chunk_i), ...] of inputs
                                     # already seen
+    n_missing_inputs = 0            # Number of wanted inputs not yet stored.
+                                    # Maintained by the Stream.
+
+    priority_key = 0.           # Minus the expected cost of the longest
+                                # chain of jobs through this one.
+                                # Set by the Stream, lower is scheduled first.
 
-    depth = 0                   # Dependency hops to final target
+    chunk_size: ty.Optional[int]    # For sources: rows per chunk to make.
+                                    # target_chunk_size, adjusted by the
+                                    # Stream to suit downstream jobs.
 
     pending_is: set             # Set of pending task numbers
     last_submitted_i = -1       # Number of last emitted task
@@ -113,6 +150,15 @@ class Job:
         self.wants_input = {dt: 0 for dt in self.depends_on}
         self.seen_input = {dt: -1 for dt in self.depends_on}
         self.pending_is = set()
+        self.external_event = None
+        self.chunk_size = self.target_chunk_size
+
+    def __getstate__(self):
+        # Executors cannot (and should not) be sent to worker processes
+        state = self.__dict__.copy()
+        state.pop('executors', None)
+        state.pop('external_event', None)
+        return state
 
     def __repr__(self):
         _from = ','.join(self.depends_on)
@@ -136,32 +182,42 @@ class Job:
 
         # Validate inputs
         # Inputs must be dicts of numpy arrays
-        for k in inputs:
-            if k not in self.wants_input:
+        if inputs.keys() != self.wants_input.keys():
+            for k in inputs.keys() - self.wants_input.keys():
                 raise RuntimeError(f"Unwanted input {k} given to {self}")
-        for k in self.wants_input:
-            if k not in inputs:
+            for k in self.wants_input.keys() - inputs.keys():
                 raise RuntimeError(f"Missing input {k} to {self}")
 
         for k in inputs:
             self.seen_input[k] += 1
-        content = partial(self.task, chunk_i=task_i, **inputs)
 
         if not self.changing_inputs:
             # Request the next set of inputs
             for dt in self.wants_input:
                 self.wants_input[dt] += 1
 
-        return self._submit_task(content, task_i, is_final=False)
-
-    def _submit_task(self, content, task_i, is_final) -> Task:
-        future = self.executors[self.submit_to].submit(content)
+        return self._submit_task('task', task_i, is_final=False,
+                                 inputs=inputs)
+
+    def _submit_task(self, method, task_i, is_final, inputs) -> Task:
+        executor = self.executors[self.submit_to]
+        shared_inputs = tuple()
+        if self.submit_to == 'process':
+            # The worker already has this job, send only the inputs
+            inputs = plarx.to_shared(inputs)
+            shared_inputs = plarx.shared_names(inputs)
+            future = executor.submit(_run_in_worker, id(self), method,
+                                     chunk_i=task_i, **inputs)
+        else:
+            future = executor.submit(getattr(self, method),
+                                     chunk_i=task_i, **inputs)
         self.last_submitted_i += 1
         return Task(
             future=future,
             job=self,
             chunk_i=task_i,
-            is_final=is_final)
+            is_final=is_final,
+            shared_inputs=shared_inputs)
 
     def get_cleanup_task(self, inputs=None):
         task_i, inputs = self._prepare_get_task(inputs)
@@ -169,8 +225,8 @@ class Job:
 
         self.final_task_submitted = True
         self.final_task_i = task_i
-        content = partial(self.cleanup, chunk_i=task_i, **inputs)
-        return self._submit_task(content, task_i, is_final=True)
+        return self._submit_task('cleanup', task_i, is_final=True,
+                                 inputs=inputs)
 
     def could_submit_new_task(self):
         """Return if we are ready to submit a new task
@@ -209,6 +265,8 @@ class Job:
         if not task.future.done():
             raise RuntimeError("get_result called before task was done")
         result = task.future.result()  # Will raise if exception
+        if self.submit_to == 'process':
+            result = plarx.from_shared(result)
 
         # Record new inputs
         if self.changing_inputs:
@@ -246,6 +304,11 @@ class Job:
 
     def task(self, chunk_i: int, **kwargs) \
             -> ty.Dict[str, ty.Any]:
+        """Process one chunk of inputs, return {dtypename: result, ...}
+
+        Results can be allocated with self.array_pool.empty(shape, dtype)
+        to reuse the memory of chunks the Stream no longer needs.
+        """
         raise NotImplementedError
 
     def cleanup(self, chunk_i: int, exception=None, **inputs) \
@@ -271,3 +334,17 @@ class Job:
         """For sources, return whether the next external input
          (i.e. self.chunk_id + 1) is ready"""
         return True
+
+    ##
+    # Functions to call
+    ##
+
+    def notify_external_ready(self):
+        """For sources, call when an external input becomes ready
+        (or inputs are exhausted). Can be called from any thread.
+
+        Otherwise, a Stream waiting for external inputs only checks
+        again every few seconds.
+        """
+        if self.external_event is not None:
+            self.external_event.set()
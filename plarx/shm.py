@@ -0,0 +1,109 @@
+from multiprocessing import resource_tracker, shared_memory
+import typing as ty
+
+import numpy as np
+
+from .common import exporter
+export, __all__ = exporter()
+
+# Arrays smaller than this are cheaper to just pickle
+MIN_SHARED_BYTES = 2 ** 16
+
+
+@export
+class SharedArray(ty.NamedTuple):
+    """Numpy array placed in a shared memory segment"""
+    name: str       # Name of the shared memory segment
+    shape: ty.Tuple[int, ...]
+    dtype: np.dtype
+
+
+@export
+def prepare_shared_memory():
+    """Start the resource tracker, so worker processes forked afterwards
+    share it with us. Otherwise each worker starts its own, and warns
+    about 'leaked' segments that we already unlinked.
+    """
+    resource_tracker.ensure_running()
+
+
+@export
+def run_and_share(f, *args, **kwargs):
+    """Return f(*args, **kwargs), with large numpy arrays in the result
+    moved to shared memory. Use from_shared to get them back.
+
+    Use this in worker processes, so results are not pickled and piped
+    back to the main process.
+    """
+    return to_shared(f(*args, **kwargs))
+
+
+@export
+def to_shared(x):
+    """Return x with large numpy arrays moved to shared memory
+
+    :param x: numpy array, or dict/tuple/list containing numpy arrays.
+    Other objects, including subclasses of numpy arrays (which could
+    have extra state, like a mask), are returned unchanged.
+    """
+    if type(x) is np.ndarray:
+        if x.nbytes < MIN_SHARED_BYTES or x.dtype.hasobject:
+            return x
+        shm = shared_memory.SharedMemory(create=True, size=x.nbytes)
+        try:
+            np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+        finally:
+            shm.close()
+        return SharedArray(name=shm.name, shape=x.shape, dtype=x.dtype)
+    if isinstance(x, dict):
+        return {k: to_shared(v) for k, v in x.items()}
+    if type(x) in (tuple, list):
+        return type(x)([to_shared(v) for v in x])
+    return x
+
+
+@export
+def from_shared(x):
+    """Return x with arrays in shared memory copied back to ordinary
+    numpy arrays, and their shared memory segments released.
+
+    :param x: Output of to_shared
+    """
+    if isinstance(x, SharedArray):
+        shm = shared_memory.SharedMemory(name=x.name)
+        try:
+            return np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+    if isinstance(x, dict):
+        return {k: from_shared(v) for k, v in x.items()}
+    if type(x) in (tuple, list):
+        return type(x)([from_shared(v) for v in x])
+    return x
+
+
+@export
+def shared_names(x) -> ty.Tuple[str, ...]:
+    """Return names of the shared memory segments in x
+
+    :param x: Output of to_shared
+    """
+    if isinstance(x, SharedArray):
+        return (x.name,)
+    if isinstance(x, dict):
+        x = x.values()
+    elif type(x) not in (tuple, list):
+        return tuple()
+    return sum([shared_names(v) for v in x], tuple())
+
+
+@export
+def unlink_shared(names: ty.Iterable[str]):
+    """Release shared memory segments without reading them,
+    e.g. the inputs of a task that was cancelled before it could run.
+    """
+    for name in names:
+        shm = shared_memory.SharedMemory(name=name)
+        shm.close()
+        shm.unlink()
@@ -1,15 +1,21 @@
 from collections import defaultdict
 import concurrent.futures as cf
 from enum import Enum
+import heapq
+import itertools
+import math
 import os
-from random import random
+import queue
+import threading
 import time
 import typing as ty
 
+import numpy as np
 import psutil
 
 import plarx
 from .common import exporter
+from .job import _init_worker
 
 export, __all__ = exporter()
 
@@ -21,38 +27,86 @@ class Signals(Enum):
     WAIT_EXTERNAL = 3
 
 
+def _discard_result(future: cf.Future):
+    """Release shared memory of the result of future, if it succeeded"""
+    if not future.cancelled() and future.exception() is None:
+        plarx.from_shared(future.result())
+
+
 @export
 class Stream:
-    pending_tasks: ty.List[plarx.Task]
+    pending_tasks: ty.Set[plarx.Task]
+    n_workers: ty.Dict[str, int]    # {executor name: max number of tasks}
+    n_pending: ty.Dict[str, int]    # {executor name: number of pending tasks}
+    done_queue: queue.Queue         # Tasks put here by future callbacks
+    done_tasks: ty.List[plarx.Task]     # Done tasks not yet processed
     stored_data: ty.Dict[str, plarx.Buffer]  # {dtypename: StoredData}
     final_target: str
     jobs: ty.List[plarx.Job]
+    consumers: ty.Dict[str, ty.List[plarx.Job]]  # {dtypename: [jobs], ...}
+    exhausted: ty.Set[str]      # Data types that will not get new chunks
+    _draining: ty.Set[str]      # Data types whose producer finished,
+                                # but still have chunks stored
+    user_buffers: ty.List[plarx.Buffer]     # Buffers yielding to the user
+    _touched: ty.Set[plarx.Buffer]  # Buffers read since the last cleanup
+    _held_back: bool            # Last _get_new_task held back sources or
+                                # jobs until some task completes, e.g.
+                                # because their executor was full
+    ready: ty.List[ty.Tuple]    # Heap of (priority, priority_key, i, job)
+                                # for jobs whose wanted inputs are all stored
     this_process: psutil.Process
+    external_event: threading.Event     # Set when an external input is ready
+    array_pool: plarx.ArrayPool
     threshold_mb = 1000
+    memory_check_interval = 0.1     # Seconds between memory usage checks
 
     def __init__(self, jobs: ty.List[plarx.Job],
-                 yield_outputs=None, max_workers=5):
+                 yield_outputs=None, max_workers=5,
+                 thread_workers=None, process_workers=None):
+        """Stream data through jobs
+
+        :param jobs: List of Jobs to run
+        :param yield_outputs: Data type(s) to yield to the user
+        :param max_workers: Number of workers in each executor,
+        unless overridden by thread_workers or process_workers
+        :param thread_workers: Number of threads, e.g. to do I/O
+        :param process_workers: Number of processes, e.g. for
+        CPU-bound jobs that do not release the GIL
+        """
         if isinstance(yield_outputs, str):
             yield_outputs = [yield_outputs]
 
-        self.max_workers = max_workers
+        self.n_workers = dict(
+            thread=thread_workers or max_workers,
+            process=process_workers or max_workers)
+        self.n_pending = {k: 0 for k in self.n_workers}
         self.jobs = jobs
 
-        def get_priority(tg: plarx.Job):
-            return tg.priority, tg.depth
-        self.jobs.sort(key=get_priority)
-
-        self.pending_tasks = []
+        self.pending_tasks = set()
+        self.done_queue = queue.Queue()
+        self.done_tasks = []
         self.this_process = psutil.Process(os.getpid())
+        self._last_memory_check = -float('inf')
+        self._last_memory_mb = 0.
 
         self.last_yielded_chunk = -1
 
+        plarx.prepare_shared_memory()
         self.executors = dict(
-            process=cf.ProcessPoolExecutor(max_workers=self.max_workers),
-            thread=cf.ThreadPoolExecutor(max_workers=self.max_workers))
+            process=cf.ProcessPoolExecutor(
+                max_workers=self.n_workers['process'],
+                initializer=_init_worker,
+                initargs=({id(job): job for job in self.jobs
+                           if job.submit_to == 'process'},)),
+            thread=cf.ThreadPoolExecutor(
+                max_workers=self.n_workers['thread']))
+        self.array_pool = plarx.ArrayPool()
+        self.external_event = threading.Event()
         # TODO: how to pass to jobs?
         for job in jobs:
             job.executors = self.executors
+            job.array_pool = self.array_pool
+            job.external_event = self.external_event
 
         who_wants = defaultdict(list)
         for job in self.jobs:
@@ -64,39 +118,164 @@ class Stream:
         for dt in yield_outputs:
             who_wants.setdefault(dt, [])
 
+        self.consumers = dict(who_wants)
         self.stored_data = {
-            dt: plarx.Buffer(dt, jobs, yield_to_user=dt in yield_outputs)
+            dt: plarx.Buffer(dt, jobs,
+                             yield_to_user=dt in yield_outputs,
+                             array_pool=self.array_pool)
             for dt, jobs in who_wants.items()}
 
+        self.user_buffers = [self.stored_data[dt] for dt in yield_outputs]
+        self._user_dtypes = set(yield_outputs)
+        self._held_back = False
+        self._touched = set()
+
+        self.exhausted = set()
+        self._draining = set()
+        self.sources = [job for job in self.jobs if job.is_source]
+        self._plan_chunk_sizes()
+        # Which consumed data types each source provides,
+        # to quickly score how much each source is needed.
+        self._source_dtypes = [
+            dt for dt in self.stored_data
+            if any([dt in s.provides for s in self.sources])]
+        self._source_provides = np.array(
+            [[dt in s.provides for dt in self._source_dtypes]
+             for s in self.sources],
+            dtype=np.int64).reshape(len(self.sources),
+                                    len(self._source_dtypes))
+        self._compute_priorities()
+        self.ready = []
+        self._queued = set()
+        self._queue_counter = itertools.count()
+        for job in self.jobs:
+            self._register_wants(job)
+
+    def _plan_chunk_sizes(self):
+        """Round the chunk size of sources to a multiple of the
+        chunk_hints of all jobs downstream of them (including themselves),
+        so those jobs do not have to buffer or split data.
+        """
+        for source in self.sources:
+            if source.target_chunk_size is None:
+                continue
+
+            # Find all jobs downstream of the source
+            downstream = {source}
+            to_visit = [source]
+            while to_visit:
+                job = to_visit.pop()
+                for dt in job.provides:
+                    for consumer in self.consumers.get(dt, []):
+                        if consumer not in downstream:
+                            downstream.add(consumer)
+                            to_visit.append(consumer)
+
+            hints = [job.chunk_hint for job in downstream if job.chunk_hint]
+            multiple = math.lcm(*hints)
+            # Round down, since the target is probably set by memory
+            # constraints. But we need at least one multiple.
+            source.chunk_size = max(
+                multiple,
+                source.target_chunk_size // multiple * multiple)
+
+    def _compute_priorities(self):
+        """Set priority_key for each job, so jobs on the critical path
+        are submitted first and release their dependents sooner.
+
+        The critical path through a job is the longest chain of
+        expected task costs from a source, through the job, to a final
+        consumer (i.e. the sum of the job's top and bottom level).
+        """
+        children = {job: [] for job in self.jobs}
+        parents = {job: [] for job in self.jobs}
+        for job in self.jobs:
+            for dt in job.provides:
+                for consumer in self.consumers.get(dt, []):
+                    children[job].append(consumer)
+                    parents[consumer].append(job)
+
+        # Topological sort (Kahn's algorithm), so we need no recursion
+        n_unsorted_parents = {job: len(parents[job]) for job in self.jobs}
+        to_visit = [job for job in self.jobs if not parents[job]]
+        order = []
+        while to_visit:
+            job = to_visit.pop()
+            order.append(job)
+            for child in children[job]:
+                n_unsorted_parents[child] -= 1
+                if not n_unsorted_parents[child]:
+                    to_visit.append(child)
+        if len(order) != len(self.jobs):
+            raise RuntimeError(
+                "Jobs depend on each other in a cycle: " + ", ".join(
+                    [job.__class__.__name__ for job in self.jobs
+                     if n_unsorted_parents[job]]))
+
+        # Cost of longest chain from job (inclusive) to the end
+        bottom_levels = dict()
+        for job in reversed(order):
+            bottom_levels[job] = job.expected_cost + max(
+                [bottom_levels[c] for c in children[job]], default=0)
+
+        # Cost of longest chain from a source to job (exclusive)
+        top_levels = dict()
+        for job in order:
+            top_levels[job] = max(
+                [top_levels[p] + p.expected_cost for p in parents[job]],
+                default=0)
+
+        for job in self.jobs:
+            job.priority_key = -(top_levels[job] + bottom_levels[job])
+
     def main_loop(self):
         while True:
             self._receive_from_done_tasks()
 
-            for sd in self.stored_data.values():
+            for sd in self.user_buffers:
                 yield from sd.yield_to_user()
+            self._touched.update(self.user_buffers)
+            # Only buffers that were read from can have chunks to remove
+            for sd in self._touched:
                 sd.cleanup()
+            self._touched.clear()
 
-            status, task = self._get_new_task()
-
-            if status is Signals.GOT_TASK:
-                self.pending_tasks += [task]
-                if len(self.pending_tasks) < self.max_workers:
-                    continue
-                self.wait_until_task_done()
-
-            elif status is Signals.NO_TASK:
-                if not self.pending_tasks:
-                    self._exit_normally()
-                    return
-                self.wait_until_task_done()
-                continue
+            status = self._submit_new_tasks()
 
-            elif status is Signals.WAIT_EXTERNAL:
+            if status is Signals.WAIT_EXTERNAL:
                 # TODO: emit who is waiting
                 self._emit_status(f"Waiting on external condition")
-                time.sleep(5)
+                # Jobs that don't notify us are polled every 5 seconds
+                self.external_event.wait(timeout=5)
+                self.external_event.clear()
                 continue
 
+            if not self.pending_tasks:
+                self._exit_normally()
+                return
+            self.wait_until_task_done()
+
+            if status is Signals.NO_TASK:
+                # Often a single result will not let us submit anything
+                # new, e.g. if each job still misses several inputs.
+                # Then just collect results until one might.
+                while not self._receive_from_done_tasks():
+                    self.wait_until_task_done()
+
+    def _submit_new_tasks(self):
+        """Submit new tasks until the workers are all busy,
+        or there is nothing more we can submit right now.
+
+        Returns the signal that made us stop.
+        """
+        while any([self.n_pending[k] < self.n_workers[k]
+                   for k in self.n_workers]):
+            status, task = self._get_new_task()
+            if status is not Signals.GOT_TASK:
+                return status
+            self._add_pending(task)
+        return Signals.GOT_TASK
+
     def _exit_normally(self):
         if any([not job.all_results_arrived
                 for job in self.jobs]):
@@ -110,121 +289,195 @@ class Stream:
         for exc in self.executors.values():
             exc.shutdown()
 
+    def _add_pending(self, task: plarx.Task):
+        self.pending_tasks.add(task)
+        self.n_pending[task.job.submit_to] += 1
+        task.future.add_done_callback(
+            lambda _, task=task: self.done_queue.put(task))
+
     def wait_until_task_done(self):
+        """Block until at least one pending task is done"""
         while True:
-            done, not_done = cf.wait(
-                [t.future for t in self.pending_tasks],
-                return_when=cf.FIRST_COMPLETED,
-                timeout=5)
-            if len(done):
-                break
-            self._emit_status("Waiting for a task to complete")
+            try:
+                self.done_tasks.append(self.done_queue.get(timeout=5))
+                return
+            except queue.Empty:
+                self._emit_status("Waiting for a task to complete")
 
     def _receive_from_done_tasks(self):
-        still_pending = []
-        for task in self.pending_tasks:
-            f = task.future
-            if not f.done():
-                still_pending.append(task)
-                continue
+        """Process results of done tasks.
+
+        Returns whether the results might let us submit new tasks
+        or yield something to the user, i.e. whether it is worth
+        running the rest of the main loop.
+        """
+        while True:
+            try:
+                self.done_tasks.append(self.done_queue.get_nowait())
+            except queue.Empty:
+                break
+        done_tasks, self.done_tasks = self.done_tasks, []
+
+        unblocked = False
+        for task in done_tasks:
+            self.pending_tasks.discard(task)
+            self.n_pending[task.job.submit_to] -= 1
 
             # Get the result
+            job = task.job
+            if (task.is_final or job.is_source
+                    or not self._user_dtypes.isdisjoint(job.provides)
+                    # Non-parallel jobs may now get their cleanup task
+                    or not self.exhausted.isdisjoint(job.depends_on)):
+                unblocked = True
             try:
-                result = task.job.get_result(task)
+                result = job.get_result(task)
             except Exception as e:
                 self.exit_with_exception(e, f"Exception from {task}")
                 raise RuntimeError("Exit failed??")  # Pycharm likes
 
+            if job.all_results_arrived:
+                # Note final tasks can return results, so we check for
+                # all_results_arrived, not final_task_submitted!
+                self._draining.update(
+                    [dt for dt in job.provides if dt in self.stored_data])
+
+            if job.changing_inputs:
+                # The job just told us what it wants next
+                self._register_wants(job)
+            else:
+                # Non-parallel jobs may have been waiting for this
+                self._mark_if_ready(job)
+
             if result is None:
                 continue
 
-            for dtype, result in result.items():
-                if dtype not in self.stored_data:
+            for dtype, data in result.items():
+                buffer = self.stored_data.get(dtype)
+                if buffer is None:
                     # TODO: make configurable error
                     # print(f"Got {dtype} which nobody wants, discarding...")
                     continue
-                self.stored_data[dtype].add(data=result, chunk_i=task.chunk_i)
-
-        self.pending_tasks = still_pending
+                for waiting_job in buffer.add(data=data, chunk_i=task.chunk_i):
+                    waiting_job.n_missing_inputs -= 1
+                    self._mark_if_ready(waiting_job)
+
+        # Ready jobs may have been waiting for room in an executor.
+        # Sources and exhausted inputs are not tracked by the ready queue.
+        return (unblocked
+                or bool(self.ready)
+                or bool(self._draining)
+                or self._held_back
+                or not self.pending_tasks)
+
+    def _register_wants(self, job: plarx.Job):
+        """Count the inputs job wants that have not yet arrived,
+        and ask their buffers to tell us when they do.
+        Call whenever job.wants_input changes.
+        """
+        if job.is_source:
+            return
+        job.n_missing_inputs = 0
+        for dtype, chunk_i in job.wants_input.items():
+            buffer = self.stored_data[dtype]
+            if chunk_i not in buffer:
+                buffer.wait_for(chunk_i, job)
+                job.n_missing_inputs += 1
+        self._mark_if_ready(job)
+
+    def _mark_if_ready(self, job: plarx.Job):
+        """Queue job for submission if all its wanted inputs are stored"""
+        if (job.is_source
+                or job.n_missing_inputs
+                or job.final_task_submitted
+                or job in self._queued):
+            return
+        heapq.heappush(self.ready, (job.priority, job.priority_key,
+                                    next(self._queue_counter), job))
+        self._queued.add(job)
 
     def _get_new_task(self):
         """Return a new task, or None, if it is wiser or necessary to wait"""
         external_waits = []    # Jobs waiting for external conditions
-        sources = []           # Sources we could load more data from
-        requests_for = defaultdict(int)  # Requests for particular inputs
-        exhausted_dtypes = self._get_exhausted()
-
-        for job in self.jobs:
-            if not job.could_submit_new_task():
-                continue
-
-            # Are any of the required inputs exhausted?
-            exhausted = False
-            if job.is_source:
-                exhausted = job.external_inputs_exhausted()
-            else:
-                for dt in job.wants_input:
-                    if dt in exhausted_dtypes:
-                        exhausted = True
-
-            # If so, start a cleanup task
-            if exhausted:
-                if job.final_task_submitted:
+        sources = []           # Indices of sources we could load data from
+        self._held_back = False
+
+        # Start cleanup tasks for jobs whose inputs are exhausted
+        for dt in self._get_exhausted():
+            for job in self.consumers.get(dt, []):
+                if (dt not in job.wants_input
+                        or not job.could_submit_new_task()):
                     continue
-                inputs = {dt: self.stored_data[dt].slurp_for(job)
-                          for dt in job.depends_on}
-                return Signals.GOT_TASK, job.get_cleanup_task(inputs)
-
-            # Check external conditions satisfied
-            if (not job.external_input_ready()
-                    and not job.external_inputs_exhausted()):
-                external_waits.append(job)
-                continue
-
-            if job.is_source:
-                # Handle these separately (at the end) regardless of priority
-                sources.append(job)
+                if not self._has_room(job):
+                    self._held_back = True
+                    continue
+                return Signals.GOT_TASK, self._get_cleanup_task(job)
+
+        # Submit a task for a job that has all its inputs
+        task = None
+        no_room = []            # Ready jobs whose executor is busy
+        while self.ready and task is None:
+            entry = heapq.heappop(self.ready)
+            job = entry[-1]
+            if not self._has_room(job):
+                no_room.append(entry)
                 continue
-
-            # Any input missing?
-            missing_input = False
-            for dtype, chunk_id in job.wants_input.items():
-                if not self.stored_data[dtype].has_stored(chunk_id):
-                    requests_for[dtype] += 1
-                    missing_input = True
-                    break
-            if missing_input:
+            self._queued.discard(job)
+            if job.n_missing_inputs or not job.could_submit_new_task():
+                # Will be queued again when its situation changes
                 continue
 
             # We're good! Grab all inputs and submit.
             task_inputs = dict()
             for dtype, chunk_i in job.wants_input.items():
-                task_inputs[dtype] = self.stored_data[dtype].grab_for(
-                    job=job, chunk_i=chunk_i)
-
-            return Signals.GOT_TASK, job.get_task(task_inputs)
+                buffer = self.stored_data[dtype]
+                task_inputs[dtype] = buffer.grab_for(job=job, chunk_i=chunk_i)
+                self._touched.add(buffer)
+            task = job.get_task(task_inputs)
+            if not job.changing_inputs:
+                self._register_wants(job)
+        for entry in no_room:
+            heapq.heappush(self.ready, entry)
+        if task is not None:
+            return Signals.GOT_TASK, task
+
+        for source_i, job in enumerate(self.sources):
+            if not job.could_submit_new_task():
+                continue
+            if not self._has_room(job):
+                self._held_back = True
+                continue
+            if job.external_inputs_exhausted():
+                return Signals.GOT_TASK, self._get_cleanup_task(job)
+            if not job.external_input_ready():
+                external_waits.append(job)
+                continue
+            sources.append(source_i)
 
         if sources:
             # No computation tasks to do, but we could load new data
-            if (self.this_process.memory_info().rss / 1e6 > self.threshold_mb
-                    and self.pending_tasks):
+            if self._memory_mb() > self.threshold_mb and self.pending_tasks:
                 # ... Let's not though; instead wait for current tasks.
                 # (We could perhaps also wait for an external condition
                 # but in all likelihood a task will complete soon enough)
+                self._held_back = True
                 return Signals.NO_TASK, None
             # Load data for the source that is blocking the most tasks
             # Jitter it a bit for better performance on ties..
-            # TODO: There is a better way, but I'm too lazy now
-            requests_for_source = [(s, sum([requests_for.get(dt, 0)
-                                            for dt in s.provides]) + random())
-                                   for s in sources]
-            s, _ = max(requests_for_source, key=lambda q: q[1])
+            requests_for = np.fromiter(
+                (self.stored_data[dt].n_waiting()
+                 for dt in self._source_dtypes),
+                dtype=np.int64, count=len(self._source_dtypes))
+            scores = (self._source_provides[sources] @ requests_for
+                      + np.random.random(len(sources)))
+            s = self.sources[sources[int(scores.argmax())]]
             return Signals.GOT_TASK, s.get_task(None)
 
         if external_waits:
             if len(self.pending_tasks):
                 # Assume an existing task will complete before the wait time.
                 # TODO: Good idea? Maybe make configurable?
+                self._held_back = True
                 return Signals.NO_TASK, None
             else:
                 return Signals.WAIT_EXTERNAL, None
@@ -232,6 +485,27 @@ class Stream:
         # No work to do. Maybe a pending task will still generate some though.
         return Signals.NO_TASK, None
 
+    def _memory_mb(self):
+        """Return memory used by this process in MB.
+        Checked at most every memory_check_interval seconds,
+        since it takes a system call.
+        """
+        now = time.monotonic()
+        if now - self._last_memory_check > self.memory_check_interval:
+            self._last_memory_mb = self.this_process.memory_info().rss / 1e6
+            self._last_memory_check = now
+        return self._last_memory_mb
+
+    def _has_room(self, job: plarx.Job):
+        """Return whether job's executor can take another task"""
+        return self.n_pending[job.submit_to] < self.n_workers[job.submit_to]
+
+    def _get_cleanup_task(self, job: plarx.Job):
+        inputs = {dt: self.stored_data[dt].slurp_for(job)
+                  for dt in job.depends_on}
+        self._touched.update([self.stored_data[dt] for dt in job.depends_on])
+        return job.get_cleanup_task(inputs)
+
     def _emit_status(self, msg):
         print(msg)
         print(f"\tPending tasks: {self.pending_tasks}")
@@ -248,6 +522,21 @@ class Stream:
                   f"\n\tis source {job.is_source}")
         for dt, d in self.stored_data.items():
             d.print_status()
+
+        # Don't start any more tasks, and don't wait for running ones
+        for t in self.pending_tasks:
+            t.future.cancel()
+        for exc in self.executors.values():
+            exc.shutdown(wait=False, cancel_futures=True)
+
+        # Release shared memory of tasks we will never receive
+        for t in self.pending_tasks:
+            if t.future.cancelled():
+                plarx.unlink_shared(t.shared_inputs)
+            elif t.job.submit_to == 'process':
+                # Runs immediately if the task is already done
+                t.future.add_done_callback(_discard_result)
+
         for job in self.jobs:
             if not job.final_task_submitted:
                 try:
@@ -256,21 +545,13 @@ class Stream:
                     print(f"Exceptional shutdown of {job} failed")
                     print(f"Got another exception: {e}")
                     pass   # These are exceptional times...
-            raise exception
-        for t in self.pending_tasks:
-            t.future.cancel()
-        self.threadpool.shutdown()
-        self.processpool.shutdown()
+        raise exception
 
     def _get_exhausted(self):
-        """Return list of provided datatypes that are exhausted"""
-        # Note final tasks can return results, so we check for
-        # all_results_arrived, not final_task_submitted!
-        exhausted = []
-        for job in self.jobs:
-            if not job.provides or not job.all_results_arrived:
-                continue
-            for p in job.provides:
-                if not self.stored_data[p].n_stored():
-                    exhausted.append(p)
-        return exhausted
+        """Return set of provided datatypes that are exhausted"""
+        if self._draining:
+            newly_exhausted = [dt for dt in self._draining
+                               if not self.stored_data[dt].n_stored()]
+            self._draining.difference_update(newly_exhausted)
+            self.exhausted.update(newly_exhausted)
+        return self.exhausted
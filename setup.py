@@ -20,13 +20,13 @@ setuptools.setup(name='plarx',
                  setup_requires=['pytest-runner'],
                  install_requires=requires,
                  tests_require=requires + ['pytest'],
-                 python_requires=">=3.6",
+                 python_requires=">=3.9",
                  packages=setuptools.find_packages(),
                  classifiers=[
                      'Development Status :: 3 - Alpha',
                      'License :: OSI Approved :: BSD License',
                      'Natural Language :: English',
-                     'Programming Language :: Python :: 3.6',
+                     'Programming Language :: Python :: 3.9',
                      'Intended Audience :: Science/Research',
                      'Programming Language :: Python :: Implementation :: CPython',
                      'Topic :: Scientific/Engineering :: Physics',
@@ -0,0 +1,55 @@
+import numpy as np
+
+import plarx
+
+
+def test_reuse():
+    pool = plarx.ArrayPool()
+    x = pool.empty((10, 3), dtype=np.float32)
+    assert x.shape == (10, 3)
+    assert x.dtype == np.float32
+    assert x.ctypes.data % pool.alignment == 0
+    address = x.ctypes.data
+
+    # Memory is not reused while someone still holds a view
+    view = x[2:]
+    pool.recycle(x)
+    del x
+    y = pool.empty(30, dtype=np.float32)
+    assert y.ctypes.data != address
+
+    # ... but is once the view is gone
+    pool.recycle(y)
+    del view, y
+    z = pool.empty(25, dtype=np.float32)
+    assert z.ctypes.data == address
+
+
+def test_recycle_foreign():
+    pool = plarx.ArrayPool()
+    pool.recycle(np.zeros(10))
+    pool.recycle(None)
+    assert pool.empty(10).shape == (10,)
+
+
+def _use_pool_in_child(pool):
+    assert not any(pool._free.values())
+    x = pool.empty(10)
+    pool.recycle(x)
+
+
+def test_fork():
+    """Forked children get a fresh pool, even if the lock was held"""
+    import multiprocessing
+    pool = plarx.ArrayPool()
+    x = pool.empty(10)
+    pool.recycle(x)
+    del x
+    with pool._lock:
+        child = multiprocessing.get_context('fork').Process(
+            target=_use_pool_in_child, args=(pool,))
+        child.start()
+        child.join(timeout=5)
+    if child.is_alive():
+        child.kill()
+    assert child.exitcode == 0
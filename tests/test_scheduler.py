@@ -1,3 +1,5 @@
+import heapq
+
 import numpy as np
 
 import plarx
@@ -132,3 +134,415 @@ def test_complex():
         assert i < 8
         np.testing.assert_array_equal(x, np.ones(11, dtype=np.int16) * i)
     assert i == 7, sched.exit_with_exception(RuntimeError(f"Ended at {i}"))
+
+
+class ProcessProc(plarx.Job):
+    provides = ('sprockets',)
+    depends_on = ('widgets',)
+    submit_to = 'process'
+
+    def task(self, chunk_i, widgets):
+        # Large enough to be returned through shared memory
+        return dict(sprockets=np.ones(100_000) * widgets[0])
+
+
+def test_process_pool():
+    """Processing in a process pool, results via shared memory"""
+    sched = plarx.Stream(
+        [BasicSource(), ProcessProc()],
+        yield_outputs='sprockets')
+    i = 0
+    for i, x in enumerate(sched.main_loop()):
+        np.testing.assert_array_equal(x, np.ones(100_000) * i)
+    assert i == 9
+
+
+def test_buffer_out_of_order():
+    job = BasicProc()
+    buffer = plarx.Buffer('widgets', [job])
+    for chunk_i in [1, 2, 0, 4]:
+        buffer.add(np.ones(3) * chunk_i, chunk_i)
+    # Chunk 3 is missing, so chunk 4 cannot be passed on yet
+    got = buffer.slurp_for(job)
+    assert [x[0] for x in got] == [0, 1, 2]
+
+
+class SlowSource(BasicSource):
+    """Source whose inputs become available one by one from a timer"""
+    n_chunks = 3
+
+    def __init__(self):
+        super().__init__()
+        self.n_available = 0
+        self._make_available()
+
+    def _make_available(self):
+        import threading
+        self.n_available += 1
+        self.notify_external_ready()
+        if self.n_available < self.n_chunks:
+            threading.Timer(0.05, self._make_available).start()
+
+    def external_input_ready(self):
+        return self.last_submitted_i + 1 < self.n_available
+
+
+def test_external_notification():
+    """Stream wakes up when a source notifies it, rather than polling"""
+    import time
+    t0 = time.time()
+    sched = plarx.Stream([SlowSource()], yield_outputs='widgets')
+    assert len(list(sched.main_loop())) == 3
+    assert time.time() - t0 < 4
+
+
+def test_chunk_size_planning():
+    class Source(BasicSource):
+        target_chunk_size = 1000
+
+    class Proc(BasicProc):
+        chunk_hint = 12
+
+    class Combination(FunnyCombination):
+        chunk_hint = 8
+
+    source, other_source = Source(), SecondSource()
+    plarx.Stream([source, Proc(), other_source, Combination()],
+                 yield_outputs='gizmos')
+    # Largest multiple of lcm(12, 8) = 24 below 1000
+    assert source.chunk_size == 984
+    assert other_source.chunk_size is None
+
+
+class CheapProc(plarx.Job):
+    depends_on = ('widgets',)
+    provides = ('cheap',)
+    expected_cost = 1.
+
+
+class CostlyProc(plarx.Job):
+    depends_on = ('widgets',)
+    provides = ('costly',)
+    expected_cost = 5.
+
+
+class Sink(plarx.Job):
+    depends_on = ('cheap', 'costly')
+    provides = ('total',)
+
+
+def test_priorities():
+    """Jobs on the critical path are submitted first"""
+    source, cheap, costly, sink = (
+        BasicSource(), CheapProc(), CostlyProc(), Sink())
+    sched = plarx.Stream([source, cheap, costly, sink],
+                         yield_outputs='total')
+    # Longest chains: source -> costly -> sink = 7, source -> cheap -> sink = 3
+    assert source.priority_key == costly.priority_key == sink.priority_key == -7
+    assert cheap.priority_key == -3
+
+    for job in (cheap, costly, sink):
+        job.n_missing_inputs = 0
+        sched._mark_if_ready(job)
+    order = [heapq.heappop(sched.ready)[-1] for _ in range(3)]
+    # Ties are broken by the order jobs became ready
+    assert order == [costly, sink, cheap]
+
+
+def test_long_chain():
+    """Priorities can be computed for many chained jobs"""
+    n = 1000
+    jobs = [BasicSource()] + [
+        type(f'Chained{i}', (plarx.Job,),
+             dict(depends_on=(f'widgets{i}' if i else 'widgets',),
+                  provides=(f'widgets{i + 1}',)))()
+        for i in range(n)]
+    plarx.Stream(jobs, yield_outputs=f'widgets{n}')
+    assert all([job.priority_key == -(n + 1) for job in jobs])
+
+
+class CyclicA(plarx.Job):
+    depends_on = ('b',)
+    provides = ('a',)
+
+
+class CyclicB(plarx.Job):
+    depends_on = ('a',)
+    provides = ('b',)
+
+
+def test_cycle():
+    import pytest
+    with pytest.raises(RuntimeError, match='cycle'):
+        plarx.Stream([BasicSource(), CyclicA(), CyclicB()],
+                     yield_outputs='widgets')
+
+
+class FailingProc(BasicProc):
+    def task(self, chunk_i, **kwargs):
+        raise ValueError("Oops")
+
+
+class CleanedSource(BasicSource):
+    n_chunks = 1000     # Should not run out before the failure
+    exception = None
+
+    def cleanup(self, chunk_i, exception=None, **inputs):
+        self.exception = exception
+
+
+def test_exception():
+    """Exceptions in tasks are raised, after all jobs are cleaned up"""
+    import pytest
+    source, other_source = CleanedSource(), CleanedSource()
+    other_source.provides = ('thingies',)
+    sched = plarx.Stream(
+        [source, FailingProc(), other_source],
+        yield_outputs=['doodads', 'thingies'])
+    with pytest.raises(ValueError, match="Oops"):
+        for _ in sched.main_loop():
+            pass
+    assert isinstance(source.exception, ValueError)
+    assert isinstance(other_source.exception, ValueError)
+
+
+class BigSource(CleanedSource):
+    def task(self, chunk_i):
+        return dict(widgets=np.ones(100_000) * chunk_i)
+
+
+class FailingProcessProc(ProcessProc):
+    def task(self, chunk_i, widgets):
+        import time
+        time.sleep(0.05)
+        if chunk_i == 5:
+            raise ValueError("Oops")
+        return super().task(chunk_i, widgets)
+
+
+def _shared_segments():
+    import glob
+    return set(glob.glob('/dev/shm/psm_*'))
+
+
+def test_exception_releases_shared_memory():
+    import concurrent.futures
+    import pytest
+    import time
+    before = _shared_segments()
+    sched = plarx.Stream(
+        [BigSource(), FailingProcessProc()],
+        yield_outputs='sprockets')
+    with pytest.raises(ValueError, match="Oops"):
+        for _ in sched.main_loop():
+            pass
+    # Tasks still running release their results once done
+    concurrent.futures.wait([t.future for t in sched.pending_tasks
+                             if not t.future.cancelled()], timeout=5)
+    t0 = time.time()
+    while _shared_segments() - before and time.time() < t0 + 5:
+        time.sleep(0.05)
+    assert not _shared_segments() - before
+
+
+def test_unlink_shared():
+    """Inputs of cancelled tasks can be released without reading them"""
+    shared = plarx.to_shared(dict(a=np.ones(100_000), b=[np.zeros(100_000)],
+                                  c=np.ones(3)))
+    names = plarx.shared_names(shared)
+    assert len(names) == 2
+    paths = {'/dev/shm/' + name for name in names}
+    assert paths <= _shared_segments()
+    plarx.unlink_shared(names)
+    assert not paths & _shared_segments()
+
+
+class SubclassProc(plarx.Job):
+    provides = ('masked', 'records')
+    depends_on = ('widgets',)
+    submit_to = 'process'
+
+    def task(self, chunk_i, widgets):
+        # Large enough for shared memory, if they were plain arrays
+        n = 100_000
+        masked = np.ma.masked_array(np.ones(n) * chunk_i,
+                                    mask=np.arange(n) % 2 == 0)
+        records = np.rec.fromarrays([np.ones(n), np.zeros(n)],
+                                    names='a,b')
+        return dict(masked=masked, records=records)
+
+
+def test_array_subclass_results():
+    """Array subclasses from worker processes keep their type and state"""
+    sched = plarx.Stream(
+        [BasicSource(), SubclassProc()],
+        yield_outputs=['masked', 'records'])
+    results = list(sched.main_loop())
+    assert len(results) == 20
+    for x in results:
+        if isinstance(x, np.ma.MaskedArray):
+            assert x.mask[0] and not x.mask[1]
+        else:
+            assert isinstance(x, np.recarray)
+            np.testing.assert_array_equal(x.a, 1)
+
+
+class MaskedSource(BasicSource):
+    def task(self, chunk_i):
+        n = 100_000
+        return dict(widgets=np.ma.masked_array(
+            np.ones(n) * chunk_i, mask=np.arange(n) % 2 == 0))
+
+
+class MaskCheckingProc(ProcessProc):
+    def task(self, chunk_i, widgets):
+        assert isinstance(widgets, np.ma.MaskedArray)
+        assert widgets.mask[0] and not widgets.mask[1]
+        return super().task(chunk_i, widgets)
+
+
+def test_array_subclass_inputs():
+    """Array subclasses sent to worker processes keep their type and state"""
+    sched = plarx.Stream(
+        [MaskedSource(), MaskCheckingProc()],
+        yield_outputs='sprockets')
+    assert len(list(sched.main_loop())) == 10
+
+
+class TimedSource(plarx.Job):
+    n_chunks = 10
+
+    def external_inputs_exhausted(self):
+        return self.last_submitted_i + 1 == self.n_chunks
+
+    def task(self, chunk_i):
+        import time
+        time.sleep(0.02)
+        return {self.provides[0]: np.ones(3) * chunk_i}
+
+
+class SourceA(TimedSource):
+    provides = ('a',)
+
+
+class SourceY(TimedSource):
+    provides = ('y',)
+
+
+class TimedProc(plarx.Job):
+    depends_on = ('a',)
+    provides = ('x',)
+
+    def task(self, chunk_i, a):
+        import time
+        time.sleep(0.02)
+        return dict(x=a)
+
+
+class Combine(plarx.Job):
+    depends_on = ('x', 'y')
+    provides = ('out',)
+
+    def task(self, chunk_i, x, y):
+        return dict(out=x + y)
+
+
+class RecordingStream(plarx.Stream):
+    """Stream that records how busy it is whenever it waits"""
+
+    def wait_until_task_done(self):
+        self.waits.append((
+            len(self.pending_tasks),
+            all([s.final_task_submitted for s in self.sources])))
+        super().wait_until_task_done()
+
+
+def test_workers_stay_busy():
+    """Freed workers are used for sources while results trickle in"""
+    sched = RecordingStream(
+        [SourceA(), TimedProc(), SourceY(), Combine()],
+        yield_outputs='out',
+        thread_workers=2)
+    sched.waits = []
+    assert len(list(sched.main_loop())) == 10
+    for n_pending, sources_done in sched.waits:
+        assert n_pending == 2 or sources_done, sched.waits
+
+
+class SlowProcessProc(ProcessProc):
+    def task(self, chunk_i, widgets):
+        import time
+        time.sleep(0.05)
+        return super().task(chunk_i, widgets)
+
+
+class PoolRecordingStream(plarx.Stream):
+    """Stream that records pending tasks per pool whenever it waits"""
+
+    def wait_until_task_done(self):
+        self.waits.append(dict(self.n_pending))
+        super().wait_until_task_done()
+
+
+def test_mixed_pools():
+    """A full process pool does not hold back tasks for the thread pool"""
+    sched = PoolRecordingStream(
+        [BasicSource(), SlowProcessProc(), BasicProc()],
+        yield_outputs=['sprockets', 'doodads'],
+        thread_workers=3,
+        process_workers=1)
+    sched.waits = []
+    assert len(list(sched.main_loop())) == 20
+    assert all([w['thread'] <= 3 and w['process'] <= 1 for w in sched.waits])
+    assert dict(thread=3, process=1) in sched.waits, sched.waits
+
+
+class ShortSource(BasicSource):
+    provides = ('b',)
+    n_chunks = 2
+
+    def task(self, chunk_i):
+        return dict(b=np.ones(3) * chunk_i)
+
+    def cleanup(self, chunk_i, exception=None, **inputs):
+        # Input of SerialProc will be exhausted during its last task
+        import time
+        time.sleep(0.15)
+
+
+class SerialProc(plarx.Job):
+    depends_on = ('b',)
+    provides = ('c',)
+    parallel = False
+    cleanup_time = None
+
+    def task(self, chunk_i, b):
+        import time
+        time.sleep(0.1)
+        return dict(c=b)
+
+    def cleanup(self, chunk_i, exception=None, **inputs):
+        import time
+        self.cleanup_time = time.time()
+
+
+class LongTaskSource(BasicSource):
+    provides = ('slow',)
+    n_chunks = 1
+
+    def task(self, chunk_i):
+        import time
+        time.sleep(0.6)
+        return dict(slow=np.ones(3))
+
+
+def test_cleanup_after_exhausted_input():
+    """Non-parallel jobs are cleaned up as soon as their last task is done,
+    even if unrelated tasks are still running"""
+    import time
+    serial = SerialProc()
+    sched = plarx.Stream([ShortSource(), serial, LongTaskSource()],
+                         yield_outputs='slow')
+    t0 = time.time()
+    assert len(list(sched.main_loop())) == 1
+    assert serial.cleanup_time - t0 < 0.4